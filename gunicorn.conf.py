@@ -0,0 +1,12 @@
+# Production server settings; gunicorn loads ./gunicorn.conf.py automatically:
+#   gunicorn main:app
+# The app mostly waits on OpenAI and Redis, so gevent workers serve many
+# concurrent requests (including open SSE streams) per process.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gevent"
+worker_connections = 1000
+timeout = 120
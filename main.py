@@ -1,8 +1,23 @@
+import functools
+import hashlib
+import inspect
 import os
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
-from flask import Flask, request, session, render_template, redirect, url_for
-from openai import OpenAI
+import httpx
+import numpy as np
+import orjson
+import redis
+from celery import Celery
+from flask import Flask, Response, request, session, render_template, redirect, url_for, jsonify
+from flask_caching import Cache
+from flask_compress import Compress
+from flask_session import Session
+from flask_session.base import Serializer
+from openai import DefaultHttpxClient, OpenAI
 from dotenv import load_dotenv
 
 # ---------------------- Load Environment ----------------------
@@ -11,18 +26,218 @@ load_dotenv()
 app = Flask(__name__, static_folder="static", template_folder="templates")
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "dev-secret")
 
-client = OpenAI()  # Uses OPENAI_API_KEY from .env
+# Keep sessions server-side in Redis: the cookie only carries the session id,
+# so the chat history is not re-signed and re-sent on every request
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+redis_client = redis.from_url(REDIS_URL)
+app.config.update(
+    SESSION_TYPE="redis",
+    SESSION_REDIS=redis_client,
+    SESSION_PERMANENT=False,
+)
+Session(app)
+
+
+class OrjsonSerializer(Serializer):
+    """Flask-Session serializer that stores sessions as JSON via orjson."""
+
+    def encode(self, session):
+        return orjson.dumps(dict(session))
+
+    def decode(self, serialized_data):
+        try:
+            return orjson.loads(serialized_data)
+        except orjson.JSONDecodeError:
+            # Session written in Flask-Session's default format: keep the sid, drop the data
+            return {}
+
+
+app.session_interface.serializer = OrjsonSerializer()
+
+# Compress HTML/JSON responses (the chat page grows with the history); the SSE
+# stream is left uncompressed because text/event-stream is not in COMPRESS_MIMETYPES.
+# Static files may be cached by browsers for a day.
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = int(os.environ.get("STATIC_MAX_AGE", "86400"))
+Compress(app)
+
+# Rendered chat pages are cached per session (see _home_cache_key)
+HOME_CACHE_TIMEOUT = int(os.environ.get("HOME_CACHE_TIMEOUT", "300"))  # seconds
+cache = Cache(app, config={"CACHE_TYPE": "RedisCache", "CACHE_REDIS_URL": REDIS_URL})
+
+# One pooled HTTP/2 client with long-lived keep-alive connections, so calls
+# reuse warm TCP/TLS connections instead of handshaking each time.
+# DefaultHttpxClient keeps the SDK's own defaults (redirects, etc.). The read timeout
+# stays at the SDK's 600 s: file_search turns can go quiet for a long time before the
+# first streamed token, and a shorter cap would cut those answers off.
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", "600"))  # seconds
+http_client = DefaultHttpxClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=100, max_connections=200, keepalive_expiry=60.0),
+    timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=5.0),
+)
+client = OpenAI(http_client=http_client)  # Uses OPENAI_API_KEY from .env
 MODEL = os.environ.get("OPENAI_MODEL", "gpt-4.1")
+ROUTER_MODEL = os.environ.get("ROUTER_MODEL", "gpt-4o-mini")  # cheap in-scope/out-of-scope check
 VECTOR_STORE_BRD = os.environ.get("VECTOR_STORE_BRD", "").strip()
 VECTOR_STORE_FSD = os.environ.get("VECTOR_STORE_FSD", "").strip()
+EMBEDDING_MODEL = os.environ.get("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.93"))
+SEMANTIC_CACHE_TTL = int(os.environ.get("SEMANTIC_CACHE_TTL", "3600"))  # seconds
+QATAR_TZ = timezone(timedelta(hours=3))  # display timezone for chat timestamps
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+CHAT_TTL = int(os.environ.get("CHAT_TTL", "2678400"))  # seconds a chat history is kept (31 days)
+STREAM_TTL = int(os.environ.get("STREAM_TTL", "600"))  # seconds streamed tokens stay replayable
+# seconds a duplicate question waits on the first; covers a full OpenAI call so a
+# follower does not give up (and pay for its own call) while the leader is still streaming
+COALESCE_WAIT = int(os.environ.get("COALESCE_WAIT", OPENAI_TIMEOUT + 60))
+# Worst case for a queued task: some time waiting for a free worker slot, up to
+# COALESCE_WAIT following a duplicate question, then its own OpenAI call. Only after all
+# of that does a task without a reply count as lost.
+QUEUE_WAIT = int(os.environ.get("QUEUE_WAIT", "300"))  # seconds a task may sit in the queue
+PENDING_TIMEOUT = int(os.environ.get("PENDING_TIMEOUT", QUEUE_WAIT + COALESCE_WAIT + OPENAI_TIMEOUT))
+STREAM_BLOCK_MS = 15000  # how long the SSE endpoint waits for new tokens before a keep-alive
+
+# ---------------------- Background Worker ----------------------
+# Run the worker with: celery -A main.celery_app worker
+celery_app = Celery("chatbot", broker=REDIS_URL, backend=REDIS_URL)
+
+
+# ---------------------- Semantic Cache ----------------------
+class SemanticCache:
+    """
+    In-memory cache of assistant replies keyed by normalized question embeddings.
+    Entries are scoped (source + previous response) so a hit never crosses documents
+    or conversation branches.
+    The cache is per process: each Celery worker child keeps its own entries, so a
+    question only hits if the same child answered a near-duplicate before.
+    """
+
+    def __init__(self, threshold, ttl, max_entries=1024):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._matrix = None  # one normalized embedding per row
+        self._entries = []  # parallel list of (scope, assistant_text, response_id, ts)
+
+    def lookup(self, embedding, scope):
+        """Return (assistant_text, response_id) of the closest fresh entry, or None."""
+        now = time.time()
+        with self._lock:
+            if not self._entries:
+                return None
+            sims = self._matrix @ embedding
+            for i, (entry_scope, _, _, ts) in enumerate(self._entries):
+                if entry_scope != scope or now - ts >= self.ttl:
+                    sims[i] = -1.0
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+            _, text, response_id, _ = self._entries[best]
+            return text, response_id
+
+    def store(self, embedding, scope, assistant_text, response_id):
+        now = time.time()
+        with self._lock:
+            # Drop expired entries and keep the cache bounded (oldest first)
+            keep = [i for i, e in enumerate(self._entries) if now - e[3] < self.ttl]
+            keep = keep[-(self.max_entries - 1):] if self.max_entries > 1 else []
+            self._entries = [self._entries[i] for i in keep]
+            rows = self._matrix[keep] if keep else np.empty((0, embedding.shape[0]), dtype=np.float32)
+
+            self._matrix = np.vstack([rows, embedding[np.newaxis, :]])
+            self._entries.append((scope, assistant_text, response_id, now))
+
+
+semantic_cache = SemanticCache(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL)
 
 
 # ---------------------- Helpers ----------------------
-def _ensure_history():
-    """Initialize a simple in-session chat history."""
-    if "chat" not in session:
-        session["chat"] = []  # list of dicts: {"role": "user"/"assistant", "text": "...", "time": "...", "response_id": "..."}
-    return session["chat"]
+def _chat_key(session_id):
+    """Redis list holding one JSON-encoded turn per item, oldest first."""
+    return f"chat:{session_id}"
+
+
+def _load_history():
+    """Read the chat history for this session."""
+    # list of dicts: {"role": "user"/"assistant", "text": "...", "time": "...", "time_local": "...", "response_id": "..."}
+    return [orjson.loads(raw) for raw in redis_client.lrange(_chat_key(session.sid), 0, -1)]
+
+
+def _last_response_key(session_id):
+    """Redis string holding the response ID of the session's latest assistant turn."""
+    return f"last_response:{session_id}"
+
+
+def _chat_id_key(session_id):
+    """Redis string holding the id of the session's current chat; /reset rotates it."""
+    return f"chat_id:{session_id}"
+
+
+def _ensure_chat_id():
+    """
+    Id of the current chat (kept in the session and mirrored to Redis for the worker).
+    Background tasks carry the id they were started for, so a reply that finishes
+    after /reset is dropped instead of landing in the new chat.
+    """
+    if "chat_id" not in session:
+        session["chat_id"] = uuid.uuid4().hex
+    # Restore the mirror if it expired; never overwrite a newer id
+    redis_client.set(_chat_id_key(session.sid), session["chat_id"], nx=True, ex=CHAT_TTL)
+    return session["chat_id"]
+
+
+# Append a turn only if the chat it belongs to is still the session's current one
+# KEYS: chat_id, chat list, last response   ARGV: chat id, turn, ttl, response id or ""
+_APPEND_TURN_SCRIPT = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+  return 0
+end
+redis.call('RPUSH', KEYS[2], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+if ARGV[4] ~= '' then
+  redis.call('SET', KEYS[3], ARGV[4], 'EX', ARGV[3])
+end
+return 1
+""")
+
+
+def _append_turn(session_id, chat_id, turn):
+    """
+    Append one turn to a session's history; only the new turn goes over the wire.
+    A turn with a response ID also becomes the session's chaining point for the next question.
+    Returns False (and writes nothing) if chat_id is no longer the session's current chat.
+    """
+    # Canned replies have no response ID; keep chaining from the last real one
+    return bool(_APPEND_TURN_SCRIPT(
+        keys=[_chat_id_key(session_id), _chat_key(session_id), _last_response_key(session_id)],
+        args=[chat_id, orjson.dumps(turn), CHAT_TTL, turn.get("response_id") or ""],
+    ))
+
+
+def _home_cache_key(*args, **kwargs):
+    """
+    Key for the rendered chat page; it changes whenever the history, source or pending task does.
+    The last turn's timestamp keeps a chat started after /reset from matching a page cached
+    for the old chat at the same length.
+    """
+    pipe = redis_client.pipeline()
+    pipe.llen(_chat_key(session.sid))
+    pipe.lindex(_chat_key(session.sid), -1)
+    length, last = pipe.execute()
+    return "home:{}:{}:{}:{}:{}".format(
+        session.sid,
+        session.get("source", "brd"),
+        length,
+        orjson.loads(last).get("time", "") if last else "",
+        session.get("pending_task", ""),
+    )
+
+
+def _invalidate_home():
+    """Drop the cached chat page for the current session state before changing it."""
+    cache.delete(_home_cache_key())
 
 
 def _ensure_source():
@@ -32,26 +247,63 @@ def _ensure_source():
     return session["source"]
 
 
-def _now_iso():
-    return datetime.now(timezone.utc).isoformat()
+def _now_times():
+    """Current time as the stored ISO (UTC) value plus its Qatar display label."""
+    now = datetime.now(timezone.utc)
+    return {"time": now.isoformat(), "time_local": now.astimezone(QATAR_TZ).strftime(TIME_FORMAT)}
 
 
+@functools.lru_cache(maxsize=1024)
 def _iso_to_local(ts: str) -> str:
     """
     Convert ISO timestamp (UTC) to Qatar local time (UTC+3)
     and render it as a readable local time label.
+    Only needed for turns stored before "time_local" was recorded.
+    The label is deterministic per timestamp, so results are memoized.
     """
     try:
-        dt_utc = datetime.fromisoformat(ts.replace("Z", "+00:00"))
-        qatar_tz = timezone(timedelta(hours=3))
-        dt_qatar = dt_utc.astimezone(qatar_tz)
-        return dt_qatar.strftime("%Y-%m-%d %H:%M")
+        # Python 3.11+ parses a trailing "Z" natively
+        dt_utc = datetime.fromisoformat(ts)
+        return dt_utc.astimezone(QATAR_TZ).strftime(TIME_FORMAT)
     except Exception:
         return ""
 
 
-def _get_system_prompt(source):
-    """Generate dynamic system prompt based on selected source."""
+def _embed(text):
+    """Embed text and L2-normalize it so a dot product is the cosine similarity."""
+    data = client.embeddings.create(model=EMBEDDING_MODEL, input=text).data[0].embedding
+    vec = np.asarray(data, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+OUT_OF_DOMAIN_MSG = "I can only answer questions that are documented in the official documents."
+NO_TEXT_MSG = "I didn't receive any text in the response."
+
+ROUTER_PROMPT = """You decide whether a question can be answered from official Business Requirements Documents (BRDs)
+and Functional Specification Documents (FSDs) describing system workflows, processes, business rules, screens and requirements.
+Questions may be in Arabic or English. Religious, legal, personal, general-knowledge or unrelated technical questions are out of scope.
+Reply with JSON only: {"in_scope": true} or {"in_scope": false}.
+
+Q: What are the approval steps for a new service request?
+A: {"in_scope": true}
+
+Q: ما هي شروط تسجيل مستخدم جديد في النظام؟
+A: {"in_scope": true}
+
+Q: Which validation rules apply to the payment screen?
+A: {"in_scope": true}
+
+Q: What's the weather in Doha today?
+A: {"in_scope": false}
+
+Q: Write me a Python script that sorts a list.
+A: {"in_scope": false}
+"""
+
+
+def _build_system_prompt(source):
+    """Build the system prompt for a source (called once per source at import time)."""
     if source == "brd":
         doc_type = "Business Requirements Documents (BRDs) in Arabic"
         scope_msg = "This question appears to be outside the scope of the BRDs."
@@ -88,7 +340,7 @@ If multiple related sections are found, merge insights and list all relevant sou
 Maintain a professional, explanatory tone suitable for analysts or technical users.
 
 If the query concerns anything outside the document domain (e.g., religious, legal, personal, or unrelated technical questions):
-"I can only answer questions that are documented in the official documents."
+"{OUT_OF_DOMAIN_MSG}"
 
 If unsure, use:
 "{scope_msg}"
@@ -99,97 +351,180 @@ If the user asks a follow-up like "What happens next?" — infer based on previo
 """
 
 
+# Built once so every request sends byte-identical prompts (keeps provider-side prompt caching effective).
+# Keep these free of per-request content such as dates or user names.
+SYSTEM_PROMPTS = {src: _build_system_prompt(src) for src in ("brd", "fsd")}
+
+
 def _extract_text_and_sources(resp):
+    """Return (text with a numbered "Sources:" list appended, whether any citation was found)."""
     text = getattr(resp, "output_text", "") or ""
-    sources = []
+    if not getattr(resp, "output", None):
+        return text, False
+
+    # de-dupe on (filename, page) in a single pass; dicts keep insertion order
+    uniq = {}
     try:
-        for item in resp.output or []:
-            for block in getattr(item, "content", []) or []:
-                for ann in getattr(block, "annotations", []) or []:
+        for item in resp.output:
+            for block in getattr(item, "content", None) or ():
+                for ann in getattr(block, "annotations", None) or ():
                     if getattr(ann, "type", None) == "file_citation":
-                        sources.append({
-                            "filename": getattr(ann, "filename", "file"),
-                            "page": getattr(ann, "page", None)
-                        })
+                        filename = getattr(ann, "filename", "file")
+                        page = getattr(ann, "page", None)
+                        uniq.setdefault((filename, page), {"filename": filename, "page": page})
     except Exception:
         pass
 
-    # de-dupe and append
-    seen, uniq = set(), []
-    for s in sources:
-        key = (s["filename"], s.get("page"))
-        if key not in seen:
-            seen.add(key)
-            uniq.append(s)
-
     if uniq:
-        text += "\n\nSources:\n"
-        for i, s in enumerate(uniq, 1):
+        lines = []
+        for i, s in enumerate(uniq.values(), 1):
             page = f", p.{s['page']}" if s.get("page") else ""
-            text += f"{i}. {s['filename']}{page}\n"
-    return text
-
-
-def _get_last_response_id():
-    """Get the most recent assistant response ID from chat history."""
-    chat = session.get("chat", [])
-    for msg in reversed(chat):
-        if msg["role"] == "assistant" and msg.get("response_id"):
-            return msg["response_id"]
-    return None
+            lines.append(f"{i}. {s['filename']}{page}")
+        text += "\n\nSources:\n" + "\n".join(lines) + "\n"
+    return text, bool(uniq)
 
 
-# ---------------------- Routes ----------------------
-@app.route("/", methods=["GET"])
-def home():
-    chat = _ensure_history()
-    source = _ensure_source()
-
-    # Convert stored ISO times to friendly strings for display
-    messages = []
-    for m in chat:
-        messages.append({
-            "role": m["role"],
-            "text": m["text"],
-            "time": _iso_to_local(m.get("time", "")),
-        })
+def _classify(q):
+    """
+    Ask the small router model whether a question is in the documents' domain.
+    Fails open: any error or unparsable reply counts as in scope.
+    """
+    try:
+        resp = client.responses.create(
+            model=ROUTER_MODEL,
+            input=[
+                {"role": "system", "content": ROUTER_PROMPT},
+                {"role": "user", "content": q}
+            ],
+            text={"format": {"type": "json_object"}},
+            store=False,  # throwaway routing call, nothing chains from it
+        )
+        return bool(orjson.loads(resp.output_text).get("in_scope", True))
+    except Exception:
+        return True
 
-    return render_template("template.html", messages=messages, source=source)
 
+# Runs _classify next to the embedding lookup so the router adds no latency of its own
+# (one slot per concurrent worker task, see CELERY_CONCURRENCY in startup.sh)
+router_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("CELERY_CONCURRENCY", "50")), thread_name_prefix="router",
+)
 
-@app.route("/toggle_source", methods=["POST"])
-def toggle_source():
-    """Toggle between BRD and FSD vector stores."""
-    current = _ensure_source()
-    session["source"] = "fsd" if current == "brd" else "brd"
-    session.modified = True
-    return redirect(url_for("home"))
 
+def _get_last_response_id():
+    """Get the most recent assistant response ID (written by the worker next to the turn)."""
+    response_id = redis_client.get(_last_response_key(session.sid))
+    return response_id.decode() if response_id else None
 
-@app.route("/ask", methods=["POST"])
-def ask():
-    q = (request.form.get("q") or "").strip()
-    if not q:
-        return redirect(url_for("home"))
 
-    chat = _ensure_history()
-    source = _ensure_source()
+def _task_done(task_id, session_id, started):
+    """
+    True once a task has finished: Celery reports it ready, its reply is already in the
+    history (the result may have expired, leaving it PENDING forever), or it has been
+    silent for longer than PENDING_TIMEOUT (e.g. the worker died).
+    """
+    if celery_app.AsyncResult(task_id).ready():
+        return True
+    last = redis_client.lindex(_chat_key(session_id), -1)
+    if last is not None and orjson.loads(last)["role"] == "assistant":
+        return True
+    return started is not None and time.time() - started > PENDING_TIMEOUT
+
+
+def _finish_pending():
+    """Clear a finished background task from the session; return its status for /ask/status."""
+    task_id = session.get("pending_task")
+    if not task_id:
+        return None
+    state = celery_app.AsyncResult(task_id).state.lower()
+    if not _task_done(task_id, session.sid, session.get("pending_since")):
+        return state
+    _invalidate_home()
+    session.pop("pending_task", None)
+    session.pop("pending_since", None)
+    # An unknown or expired result still reads "pending"; report it as finished
+    return state if state in ("success", "failure", "revoked") else "done"
+
+
+def _stream_response(on_delta, **kwargs):
+    """Stream a Responses API call, passing each text delta to on_delta, and return the final response."""
+    with client.responses.stream(**kwargs) as stream:
+        for event in stream:
+            if event.type == "response.output_text.delta":
+                on_delta(event.delta)
+        return stream.get_final_response()
+
+
+def _accepts_kwarg(fn, name):
+    """True if fn can be called with keyword argument `name`."""
+    return any(
+        p.name == name or p.kind is inspect.Parameter.VAR_KEYWORD
+        for p in inspect.signature(fn).parameters.values()
+    )
+
+
+# Probe the SDK once instead of trying the modern call and catching TypeError on every request
+USE_TOOL_RESOURCES = _accepts_kwarg(client.responses.stream, "tool_resources")
+
+
+def _stream_with_store(on_delta, kwargs, vector_store_id):
+    """Stream a file_search call against vector_store_id using the call style this SDK supports."""
+    if USE_TOOL_RESOURCES:
+        # modern style (new SDK)
+        return _stream_response(
+            on_delta,
+            **kwargs,
+            tools=[{"type": "file_search"}],
+            tool_resources={"file_search": {"vector_store_ids": [vector_store_id]}},
+        )
+    # fallback for older SDKs
+    return _stream_response(
+        on_delta,
+        **kwargs,
+        tools=[{
+            "type": "file_search",
+            "vector_store_ids": [vector_store_id],
+        }],
+    )
+
+
+def _publish(task_id, event, data, **fields):
+    """Append an event to the task's Redis stream, where /ask/stream picks it up."""
+    key = f"stream:{task_id}"
+    pipe = redis_client.pipeline()
+    pipe.xadd(key, {"event": event, "data": data, **fields})
+    pipe.expire(key, STREAM_TTL)
+    pipe.execute()
+
+
+def _reply_text(resp, has_store):
+    """
+    Turn a finished response into the text users see: the answer plus its Sources list,
+    or the out-of-scope message when a file_search answer cites nothing.
+    Returns (assistant_text, replaced_as_uncited).
+    """
+    assistant_text, had_sources = _extract_text_and_sources(resp)
+    uncited = has_store and not had_sources
+    if uncited:
+        assistant_text = "This question appears to be outside the scope of the BRDs and FSDs."
 
-    # 1) Add the user message
-    chat.append({"role": "user", "text": q, "time": _now_iso()})
-    session.modified = True
+    if not assistant_text.strip():
+        assistant_text = NO_TEXT_MSG
 
-    # 2) Select the appropriate vector store based on current source
-    vector_store_id = VECTOR_STORE_BRD if source == "brd" else VECTOR_STORE_FSD
+    return assistant_text, uncited
 
-    # 3) Get the previous response ID for multi-turn conversation
-    previous_response_id = _get_last_response_id()
 
-    # 4) Build the input for the current turn
+def _ask_model(q, source, vector_store_id, previous_response_id, on_delta, on_replace):
+    """
+    Stream the Responses API answer for one turn, passing text deltas to on_delta,
+    and return the final (assistant_text, response_id). on_replace receives the
+    final text when it supersedes what was already streamed.
+    """
+    # 1) Build the input for the current turn
     # If this is the first message, include system prompt with the user message
     if previous_response_id is None:
         input_content = [
-            {"role": "system", "content": _get_system_prompt(source)},
+            {"role": "system", "content": SYSTEM_PROMPTS[source]},
             {"role": "user", "content": q}
         ]
     else:
@@ -197,7 +532,7 @@ def ask():
         # The previous context is maintained via previous_response_id
         input_content = q
 
-    # 5) Build kwargs
+    # 2) Build kwargs
     kwargs = {
         "model": MODEL,
         "input": input_content,
@@ -211,49 +546,276 @@ def ask():
     has_store = bool(vector_store_id)
 
     if has_store:
-        try:
-            # modern style (new SDK)
-            resp = client.responses.create(
-                **kwargs,
-                tools=[{"type": "file_search"}],
-                tool_resources={"file_search": {"vector_store_ids": [vector_store_id]}},
-            )
-        except TypeError:
-            # fallback for older SDKs
-            resp = client.responses.create(
-                **kwargs,
-                tools=[{
-                    "type": "file_search",
-                    "vector_store_ids": [vector_store_id],
-                }],
-            )
+        resp = _stream_with_store(on_delta, kwargs, vector_store_id)
     else:
         # No vector store configured: still answer, but likely out-of-scope
-        resp = client.responses.create(**kwargs)
+        resp = _stream_response(on_delta, **kwargs)
 
-    # 6) Extract text + citations
-    assistant_text = _extract_text_and_sources(resp)
-    if has_store and "Sources:" not in assistant_text:
-        assistant_text = "This question appears to be outside the scope of the BRDs and FSDs."
+    # 3) Extract text + citations
+    assistant_text, uncited = _reply_text(resp, has_store)
+    if uncited:
+        # The uncited answer has already been streamed; the client must swap it out
+        on_replace(assistant_text)
+
+    return assistant_text, resp.id
+
+
+def _inflight_key(q, source):
+    """Key shared by identical first-turn questions (case and whitespace insensitive)."""
+    digest = hashlib.sha256(" ".join(q.casefold().split()).encode()).hexdigest()
+    return f"inflight:{source}:{digest}"
+
+
+def _follow(leader_id, task_id):
+    """
+    Relay another task's tokens into this task's stream and return its answer as
+    (assistant_text, None), or None if it failed or took too long. The leader's
+    response_id belongs to the leader's conversation, so followers start their own chain.
+    """
+    last_id = "0"
+    deadline = time.monotonic() + COALESCE_WAIT
+    while time.monotonic() < deadline:
+        batches = redis_client.xread({f"stream:{leader_id}": last_id}, block=1000)
+        for entry_id, fields in (batches[0][1] if batches else ()):
+            last_id = entry_id
+            event = fields[b"event"].decode()
+            if event in ("delta", "replace"):
+                _publish(task_id, event, fields[b"data"].decode())
+            elif event == "done":
+                return fields[b"data"].decode(), None
+            else:
+                return None
+    return None
+
+
+def _coalesced_ask(task_id, q, source, vector_store_id, previous_response_id, coalesce=True):
+    """
+    Answer one turn, sharing a single provider call between identical first-turn
+    questions that are in flight at the same time. Follow-ups depend on their own
+    previous_response_id and always get their own call.
+    """
+    def ask_model():
+        return _ask_model(
+            q, source, vector_store_id, previous_response_id,
+            on_delta=lambda delta: _publish(task_id, "delta", delta),
+            on_replace=lambda text: _publish(task_id, "replace", text),
+        )
+
+    if not coalesce or previous_response_id is not None:
+        return ask_model()
+
+    lock_key = _inflight_key(q, source)
+    if not redis_client.set(lock_key, task_id, nx=True, ex=COALESCE_WAIT):
+        # Another worker is already answering this question: reuse its answer
+        leader_id = redis_client.get(lock_key)
+        shared = _follow(leader_id.decode(), task_id) if leader_id else None
+        return shared if shared is not None else ask_model()
+
+    try:
+        return ask_model()
+    finally:
+        if redis_client.get(lock_key) == task_id.encode():
+            redis_client.delete(lock_key)
 
-    if not assistant_text.strip():
-        assistant_text = "I didn't receive any text in the response."
 
-    # 7) Append assistant reply to chat with response ID
-    chat.append({
+@celery_app.task(bind=True)
+def run_completion(self, session_id, chat_id, q, source, previous_response_id, use_cache=True):
+    """
+    Answer one turn off the request thread: stream tokens to stream:{task_id}
+    and append the final assistant reply to the chat:{session_id} history,
+    unless the chat was reset (chat_id rotated) in the meantime.
+    """
+    task_id = self.request.id
+    try:
+        # 1) Select the appropriate vector store based on the source
+        vector_store_id = VECTOR_STORE_BRD if source == "brd" else VECTOR_STORE_FSD
+
+        # 2) Serve near-duplicate questions from the semantic cache
+        # (best effort: an embeddings error only skips the cache, never fails the turn).
+        # First questions start the router check first so it runs during the lookup.
+        in_scope = router_pool.submit(_classify, q) if previous_response_id is None else None
+        cache_scope = (source, previous_response_id)
+        embedding = cached = None
+        if use_cache:
+            try:
+                embedding = _embed(q)
+                cached = semantic_cache.lookup(embedding, cache_scope)
+            except Exception:
+                app.logger.warning("Semantic cache lookup failed; answering without it", exc_info=True)
+                embedding = None
+
+        if cached is not None:
+            if in_scope is not None:
+                in_scope.cancel()  # not needed anymore (only helps if it has not started)
+            assistant_text, response_id = cached
+        elif in_scope is not None and not in_scope.result():
+            # Out-of-scope first question: answer without the big model
+            # (follow-ups always go through, their meaning depends on earlier turns)
+            assistant_text, response_id = OUT_OF_DOMAIN_MSG, None
+        else:
+            assistant_text, response_id = _coalesced_ask(
+                task_id, q, source, vector_store_id, previous_response_id, coalesce=use_cache,
+            )
+            # A first-turn entry is shared by every new chat, so it keeps only the text:
+            # handing out its response_id would chain the next follow-up onto the
+            # storer's conversation. Follow-up scopes belong to one conversation already.
+            if embedding is not None and assistant_text != NO_TEXT_MSG:
+                cached_id = response_id if previous_response_id is not None else None
+                try:
+                    semantic_cache.store(embedding, cache_scope, assistant_text, cached_id)
+                except Exception:
+                    app.logger.warning("Semantic cache store failed", exc_info=True)
+    except Exception:
+        # Leave a visible answer so the question is not left hanging in the history
+        _append_turn(session_id, chat_id, {
+            "role": "assistant",
+            "text": "Something went wrong, please try again.",
+            **_now_times(),
+        })
+        _publish(task_id, "failed", "")
+        raise
+
+    # 3) Append assistant reply to chat with response ID (dropped if the chat was reset)
+    _append_turn(session_id, chat_id, {
         "role": "assistant",
         "text": assistant_text,
-        "time": _now_iso(),
-        "response_id": resp.id  # Store the response ID for future multi-turn
+        **_now_times(),
+        "response_id": response_id  # Store the response ID for future multi-turn
     })
-    session.modified = True
 
+    # 4) Tell the stream the final text (citations or scope message included)
+    _publish(task_id, "done", assistant_text, response_id=response_id or "")
+    return response_id
+
+
+def _sse(event_id, event, data):
+    """Format one Server-Sent Event; multi-line data needs a data: prefix per line."""
+    lines = "".join(f"data: {line}\n" for line in data.split("\n"))
+    return f"id: {event_id}\nevent: {event}\n{lines}\n"
+
+
+# ---------------------- Routes ----------------------
+@app.route("/", methods=["GET"])
+@cache.cached(timeout=HOME_CACHE_TIMEOUT, make_cache_key=_home_cache_key)
+def home():
+    chat = _load_history()
+    source = _ensure_source()
+
+    # Use the display time recorded with each turn (older turns fall back to conversion)
+    messages = []
+    for m in chat:
+        messages.append({
+            "role": m["role"],
+            "text": m["text"],
+            "time": m.get("time_local") or _iso_to_local(m.get("time", "")),
+        })
+
+    return render_template(
+        "template.html",
+        messages=messages,
+        source=source,
+        pending_task=session.get("pending_task"),
+    )
+
+
+@app.route("/toggle_source", methods=["POST"])
+def toggle_source():
+    """Toggle between BRD and FSD vector stores."""
+    current = _ensure_source()
+    _invalidate_home()
+    session["source"] = "fsd" if current == "brd" else "brd"
+    session.modified = True
     return redirect(url_for("home"))
 
 
+@app.route("/ask", methods=["POST"])
+def ask():
+    q = (request.form.get("q") or "").strip()
+    if not q:
+        return redirect(url_for("home"))
+
+    source = _ensure_source()
+    # Clear a finished task even if its status was never polled
+    _finish_pending()
+    if session.get("pending_task"):
+        # One turn at a time: a second question would chain from a stale response ID
+        # and interleave its turns with the unfinished one
+        return jsonify({"task_id": session["pending_task"], "status": "busy"}), 409
+
+    # 1) Add the user message
+    _invalidate_home()
+    chat_id = _ensure_chat_id()
+    _append_turn(session.sid, chat_id, {"role": "user", "text": q, **_now_times()})
+
+    # 2) Get the previous response ID for multi-turn conversation
+    previous_response_id = _get_last_response_id()
+
+    # 3) Hand the model call to the background worker
+    # (a hidden "no_cache" form field opts sensitive prompts out of the semantic cache)
+    use_cache = request.form.get("no_cache") != "1"
+    task = run_completion.delay(session.sid, chat_id, q, source, previous_response_id, use_cache)
+    session["pending_task"] = task.id
+    session["pending_since"] = time.time()
+
+    return jsonify({
+        "task_id": task.id,
+        "status_url": url_for("ask_status", task_id=task.id),
+    }), 202
+
+
+@app.route("/ask/status/<task_id>", methods=["GET"])
+def ask_status(task_id):
+    """Report the state of a background completion; clear it from the session once it is done."""
+    if task_id != session.get("pending_task"):
+        return jsonify({"task_id": task_id, "status": "unknown"}), 404
+
+    return jsonify({"task_id": task_id, "status": _finish_pending()})
+
+
+@app.route("/ask/stream/<task_id>", methods=["GET"])
+def ask_stream(task_id):
+    """Forward a background completion's tokens to the browser as Server-Sent Events."""
+    if task_id != session.get("pending_task"):
+        return jsonify({"task_id": task_id, "status": "unknown"}), 404
+
+    key = f"stream:{task_id}"
+    session_id, started = session.sid, session.get("pending_since")
+    # EventSource resends the last id it saw when it reconnects; the stream replays from there
+    last_id = request.headers.get("Last-Event-ID", "0")
+
+    def generate(last_id):
+        while True:
+            batches = redis_client.xread({key: last_id}, block=STREAM_BLOCK_MS)
+            if not batches:
+                # Nothing new: give up if the task finished without publishing, else keep the connection alive
+                if _task_done(task_id, session_id, started):
+                    yield _sse(last_id, "failed", "")
+                    return
+                yield ": keep-alive\n\n"
+                continue
+            for entry_id, fields in batches[0][1]:
+                last_id = entry_id.decode()
+                event = fields[b"event"].decode()
+                yield _sse(last_id, event, fields[b"data"].decode())
+                if event in ("done", "failed"):
+                    return
+
+    return Response(
+        generate(last_id),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/reset", methods=["POST"])
 def reset():
-    session.pop("chat", None)
+    _invalidate_home()
+    session.pop("pending_task", None)
+    session.pop("pending_since", None)
+    # Start a new chat id first so a still-running task can no longer write into this session
+    session["chat_id"] = uuid.uuid4().hex
+    redis_client.set(_chat_id_key(session.sid), session["chat_id"], ex=CHAT_TTL)
+    redis_client.delete(_chat_key(session.sid), _last_response_key(session.sid))
     # Keep the source selection when resetting chat
     return redirect(url_for("home"))
 
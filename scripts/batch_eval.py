@@ -0,0 +1,140 @@
+"""
+Run a set of questions through the Batch API instead of the interactive /ask path.
+
+Batch jobs cost half as much as synchronous calls and use their own rate limit,
+so use this for anything that doesn't need interactive latency (eval sets,
+re-running historical Q&A). Results arrive within the 24h completion window.
+Requests use the same prompt and vector store as /ask, and answers get the same
+post-processing (Sources list, out-of-scope replacement) as what users see.
+
+Usage (from the repository root):
+    python -m scripts.batch_eval questions.jsonl --out results.jsonl
+    python -m scripts.batch_eval --batch-id batch_abc123 --out results.jsonl   # resume polling
+
+Each input line is a JSON object: {"q": "...", "source": "brd" | "fsd", "id": "optional"}
+"""
+import argparse
+import json
+import time
+
+from openai.types.responses import Response
+
+from main import client, MODEL, SYSTEM_PROMPTS, VECTOR_STORE_BRD, VECTOR_STORE_FSD, _reply_text
+
+TERMINAL_STATES = ("completed", "failed", "expired", "cancelled")
+
+
+def _build_request(custom_id, q, source):
+    """One /v1/responses request line in the Batch API input format."""
+    vector_store_id = VECTOR_STORE_BRD if source == "brd" else VECTOR_STORE_FSD
+    body = {
+        "model": MODEL,
+        "input": [
+            {"role": "system", "content": SYSTEM_PROMPTS[source]},
+            {"role": "user", "content": q}
+        ],
+    }
+    if vector_store_id:
+        body["tools"] = [{"type": "file_search", "vector_store_ids": [vector_store_id]}]
+    return {"custom_id": custom_id, "method": "POST", "url": "/v1/responses", "body": body}
+
+
+def write_requests(questions_path, requests_path):
+    """Convert the questions file into a Batch API input file; return the questions by custom_id."""
+    questions = {}
+    with open(questions_path, encoding="utf-8") as src, open(requests_path, "w", encoding="utf-8") as dst:
+        for n, line in enumerate(src, 1):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            custom_id = str(row.get("id") or f"q-{n}")
+            source = row.get("source", "brd")
+            if source not in SYSTEM_PROMPTS:
+                raise SystemExit(f"{questions_path}:{n}: unknown source {source!r} (expected 'brd' or 'fsd')")
+            questions[custom_id] = {"q": row["q"], "source": source}
+            dst.write(json.dumps(_build_request(custom_id, row["q"], source), ensure_ascii=False) + "\n")
+    return questions
+
+
+def submit(requests_path):
+    """Upload the input file and start the batch."""
+    with open(requests_path, "rb") as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    return client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/responses",
+        completion_window="24h",
+    )
+
+
+def wait(batch_id, poll_seconds):
+    """Poll the batch until it reaches a terminal state."""
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        done = f"{counts.completed + counts.failed}/{counts.total}" if counts else "?"
+        print(f"{batch.id}: {batch.status} ({done})")
+        if batch.status in TERMINAL_STATES:
+            return batch
+        time.sleep(poll_seconds)
+
+
+def _answer(body):
+    """Parse a raw /v1/responses body and post-process it exactly like /ask does."""
+    resp = Response.model_validate(body)
+    has_store = any(getattr(tool, "type", None) == "file_search" for tool in resp.tools or ())
+    return _reply_text(resp, has_store)[0]
+
+
+def download(batch, out_path, questions=None):
+    """Write one result line per request: custom_id, question (if known), answer or error."""
+    questions = questions or {}
+    rows = []
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get("response") or {}
+            row = {"custom_id": result["custom_id"], **questions.get(result["custom_id"], {})}
+            if result.get("error") or response.get("status_code") != 200:
+                row["error"] = result.get("error") or response.get("body")
+            else:
+                row["answer"] = _answer(response["body"])
+            rows.append(row)
+
+    with open(out_path, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate questions offline via the OpenAI Batch API.")
+    parser.add_argument("questions", nargs="?", help="JSONL file of {q, source, id} rows")
+    parser.add_argument("--out", default="batch_results.jsonl", help="where to write the results")
+    parser.add_argument("--requests", default="batch_requests.jsonl", help="where to write the batch input file")
+    parser.add_argument("--batch-id", help="poll and download an already submitted batch")
+    parser.add_argument("--poll", type=int, default=60, help="seconds between status checks")
+    args = parser.parse_args()
+
+    questions = None
+    if args.batch_id:
+        batch_id = args.batch_id
+    elif args.questions:
+        questions = write_requests(args.questions, args.requests)
+        batch_id = submit(args.requests).id
+        print(f"Submitted {len(questions)} requests as {batch_id}")
+    else:
+        parser.error("pass a questions file or --batch-id")
+
+    batch = wait(batch_id, args.poll)
+    if batch.status != "completed":
+        raise SystemExit(f"Batch {batch.id} ended as {batch.status}")
+    print(f"Wrote {download(batch, args.out, questions)} results to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
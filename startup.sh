@@ -0,0 +1,15 @@
+#!/bin/sh
+# Azure App Service startup command (App Service runs a single command and ignores the Procfile):
+#   az webapp config set -g <group> -n chatbot-brds-fsds --startup-file "sh startup.sh"
+# Starts the Celery worker next to gunicorn in the same container. Set RUN_WORKER=0
+# when the worker runs elsewhere (e.g. a separate App Service or Container App).
+set -e
+
+if [ "${RUN_WORKER:-1}" = "1" ]; then
+  # Tasks spend almost all their time blocked on OpenAI streams (up to OPENAI_TIMEOUT)
+  # or following a duplicate question, so use green threads rather than a handful of
+  # prefork processes that a few slow answers would fill.
+  celery -A main.celery_app worker --loglevel=info --pool=gevent --concurrency="${CELERY_CONCURRENCY:-50}" &
+fi
+
+exec gunicorn main:app